@@ -0,0 +1,68 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+#
+# Compiled version of py_parse_oldest_windows in redis_sample_prometheus.py.
+# Keys are scanned straight from the bytes buffer instead of going through
+# bytes.split() and per-field isdigit()/int() calls. Build it in place with:
+#
+#     cythonize -i _scanparse.pyx
+
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_GET_SIZE
+from libc.string cimport memchr
+
+cdef enum:
+    # Longest timestamp parsed as a C integer, longer ones go through int()
+    MAX_FAST_DIGITS = 18
+
+
+cdef inline bint all_digits(const char *data, Py_ssize_t size):
+    cdef Py_ssize_t i
+    if size == 0:
+        return False
+    for i in range(size):
+        if data[i] < c'0' or data[i] > c'9':
+            return False
+    return True
+
+
+def parse_oldest_windows(keys):
+    cdef dict oldest_windows = {}
+    cdef bytes key
+    cdef const char *data
+    cdef const char *first
+    cdef const char *second
+    cdef Py_ssize_t size, timestamp_size, i
+    cdef long long fast_timestamp
+    cdef object timestamp, window, oldest
+
+    for key in keys:
+        data = PyBytes_AS_STRING(key)
+        size = PyBytes_GET_SIZE(key)
+
+        # "<timestamp>:<window_size>:<uuid>", the uuid may contain colons
+        first = <const char *>memchr(data, c':', size)
+        if first == NULL:
+            continue
+        second = <const char *>memchr(first + 1, c':', size - (first + 1 - data))
+        if second == NULL:
+            continue
+
+        timestamp_size = first - data
+        if not all_digits(data, timestamp_size):
+            continue
+        if not all_digits(first + 1, second - first - 1):
+            continue
+
+        if timestamp_size <= MAX_FAST_DIGITS:
+            fast_timestamp = 0
+            for i in range(timestamp_size):
+                fast_timestamp = fast_timestamp * 10 + (data[i] - c'0')
+            timestamp = fast_timestamp
+        else:
+            timestamp = int(key[:timestamp_size])
+
+        window = (key[timestamp_size + 1 : second - data], key[second + 1 - data :])
+        oldest = oldest_windows.get(window)
+        if oldest is None or timestamp < (<tuple>oldest)[0]:
+            oldest_windows[window] = (timestamp, key)
+
+    return oldest_windows
@@ -1,10 +1,16 @@
 import time
-import re
 import argparse
+import hashlib
 import logging
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from typing import Dict, Tuple
 import redis
 from redis.cluster import RedisCluster, ClusterNode
+from redis.exceptions import NoPermissionError, NoScriptError, RedisError
+from redis.utils import HIREDIS_AVAILABLE
 from prometheus_client import start_http_server, Gauge
 
 # Configure logging
@@ -22,13 +28,50 @@ rate_limiting_total_requests = Gauge(
 rate_limiting_window_requests = Gauge(
     "rate_limiting_window_requests",
     "Requests for specific rate limiting window",
-    ["instance", "window_size", "uuid", "identifier"],
+    ["instance", "window_size", "uuid"],
 )
 
-shutdown_flag = False
+# Set to stop the background collection thread
+shutdown_event = threading.Event()
+
+# Match any key with two colons, "<timestamp>:<window_size>:<uuid>"
+KEY_PATTERN = "*:*:*"
+
+# Server side SCAN TYPE filter, set by main() when every node supports it
+scan_type = None
+
+# Sums all fields of each window hash server side so only one total per key
+# is returned
+SUM_WINDOW_SCRIPT = """
+local totals = {}
+for i, key in ipairs(KEYS) do
+    local total = 0
+    for _, value in ipairs(redis.call('HVALS', key)) do
+        total = total + tonumber(value)
+    end
+    totals[i] = total
+end
+return totals
+"""
+SUM_WINDOW_SHA = hashlib.sha1(SUM_WINDOW_SCRIPT.encode()).hexdigest()
+
+# Cleared once the ACL refuses the sum script, windows are then summed client
+# side from HGETALL
+use_sum_script = True
+
+# Maximum number of windows summed by a single script call, so one call never
+# blocks Redis for long
+SUM_WINDOW_BATCH_SIZE = 100
 
 # Global variable to store the previous window counts and their last seen timestamps
-previous_window_counts: Dict[str, Tuple[int, float]] = {}
+previous_window_counts: Dict[Tuple[str, str], Tuple[int, float]] = {}
+previous_window_counts_lock = threading.Lock()
+
+# Pipeline reused by sum_windows across polls, with the client it belongs to
+window_pipeline = None
+
+# Label children of rate_limiting_window_requests, keyed by their label values
+window_gauges: Dict[Tuple[str, ...], Gauge] = {}
 
 
 def create_redis_client(host, port, username, password, ssl, is_cluster):
@@ -37,12 +80,21 @@ def create_redis_client(host, port, username, password, ssl, is_cluster):
         "port": port,
         "password": password,
         "ssl": ssl,
-        "decode_responses": True,
+        # Replies stay bytes; only the labels of counted windows are decoded
+        "decode_responses": False,
+        # Read replies in larger chunks to cut recv() calls on big SCAN pages
+        "socket_read_size": 1 << 16,
     }
 
     if username:
         connection_kwargs["username"] = username
 
+    if not HIREDIS_AVAILABLE:
+        logging.warning(
+            "hiredis is not installed, replies are parsed by the slower "
+            "pure Python parser"
+        )
+
     try:
         if is_cluster:
             nodes = [ClusterNode(host, port)]
@@ -66,60 +118,354 @@ def create_redis_client(host, port, username, password, ssl, is_cluster):
         raise
 
 
-def count_rl_counters(r, keep_zero):
+def supports_scan_type(r):
+    # SCAN ... TYPE was added in Redis 6.0
+    if isinstance(r, RedisCluster):
+        clients = [r.get_redis_connection(node) for node in r.get_primaries()]
+    else:
+        clients = [r]
+
+    try:
+        versions = [str(client.info("server")["redis_version"]) for client in clients]
+    except RedisError as e:
+        logging.warning(f"Could not read the Redis version: {e}")
+        return False
+    return all(int(version.split(".")[0]) >= 6 for version in versions)
+
+
+def scan_node(r, node, scan_count):
+    node_client = r.get_redis_connection(node)
+    return list(
+        node_client.scan_iter(match=KEY_PATTERN, count=scan_count, _type=scan_type)
+    )
+
+
+def scan_keys(r, scan_count):
+    if not isinstance(r, RedisCluster):
+        return r.scan_iter(match=KEY_PATTERN, count=scan_count, _type=scan_type)
+
+    # Scan every primary concurrently instead of walking the shards one by one
+    primaries = r.get_primaries()
+    try:
+        with ThreadPoolExecutor(max_workers=len(primaries)) as executor:
+            futures = [
+                executor.submit(scan_node, r, node, scan_count) for node in primaries
+            ]
+            node_keys = [future.result() for future in futures]
+    except RedisError as e:
+        # Topology changes (failover, resharding) are handled by the cluster
+        # client, fall back to its sequential scan
+        logging.warning(f"Parallel cluster scan failed, retrying sequentially: {e}")
+        return r.scan_iter(match=KEY_PATTERN, count=scan_count, _type=scan_type)
+    return chain.from_iterable(node_keys)
+
+
+class KeyspaceTracker:
+    # Keeps the set of counter keys current from keyspace notifications so
+    # polls do not have to SCAN the whole keyspace. Notifications are
+    # fire-and-forget (lost while disconnected, not replayed after a
+    # failover), so the set is rebuilt from a full scan every
+    # full_scan_interval seconds. Requires notify-keyspace-events to include
+    # "Eghxe" on the server.
+
+    ADDED_EVENTS = ("hset", "hincrby", "hincrbyfloat")
+    REMOVED_EVENTS = ("del", "expired", "evicted")
+
+    def __init__(self, r, full_scan_interval):
+        self.r = r
+        self.full_scan_interval = full_scan_interval
+        self.lock = threading.Lock()
+        self.keys = set()
+        # Changes seen while a full scan is running, applied on top of it
+        self.added = set()
+        self.removed = set()
+        self.last_full_scan = None
+        self.workers = []
+        # Counters are only read from the client's database, cluster mode
+        # only has db 0
+        if isinstance(r, RedisCluster):
+            self.db = 0
+        else:
+            self.db = r.connection_pool.connection_kwargs.get("db", 0)
+        self.channel_prefix = f"__keyevent@{self.db}__:".encode()
+        # Cleared when a subscriber fails, events may have been missed since
+        self.healthy = True
+
+    def node_clients(self):
+        if isinstance(self.r, RedisCluster):
+            # Notifications are only published on the node owning the key
+            return [
+                self.r.get_redis_connection(node) for node in self.r.get_primaries()
+            ]
+        return [self.r]
+
+    def start(self):
+        clients = self.node_clients()
+
+        handlers = {}
+        for event in self.ADDED_EVENTS:
+            handlers[f"__keyevent@{self.db}__:{event}"] = self.handle_added
+        for event in self.REMOVED_EVENTS:
+            handlers[f"__keyevent@{self.db}__:{event}"] = self.handle_removed
+
+        for client in clients:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.psubscribe(**handlers)
+            except RedisError:
+                pubsub.close()
+                raise
+            self.workers.append(
+                pubsub.run_in_thread(
+                    sleep_time=1,
+                    daemon=True,
+                    exception_handler=self.handle_worker_error,
+                )
+            )
+        self.healthy = True
+        logging.info(f"Following keyspace notifications on {len(clients)} node(s)")
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+    def restart(self):
+        self.stop()
+        try:
+            self.start()
+        except RedisError as e:
+            self.stop()
+            self.healthy = False
+            logging.warning(f"Could not re-subscribe to keyspace notifications: {e}")
+
+    def check_server_config(self):
+        # "A" is an alias for every event class except the K and E channels
+        required = "Eghxe"
+        for client in self.node_clients():
+            try:
+                config = client.config_get("notify-keyspace-events")
+            except RedisError as e:
+                logging.warning(
+                    f"Could not verify notify-keyspace-events, make sure it "
+                    f"includes {required}: {e}"
+                )
+                return
+            flags = next(iter(config.values()), b"")
+            if isinstance(flags, bytes):
+                flags = flags.decode()
+            missing = [
+                flag
+                for flag in required
+                if flag not in flags and not (flag != "E" and "A" in flags)
+            ]
+            if missing:
+                logging.warning(
+                    f"notify-keyspace-events is {flags!r} and lacks "
+                    f"{''.join(missing)!r}, new and expired windows are only "
+                    "noticed by the periodic full scan"
+                )
+
+    def handle_worker_error(self, error, pubsub, worker):
+        # Anything published while the subscriber is down is lost, stop it
+        # and let the next snapshot rescan and re-subscribe
+        logging.warning(f"Keyspace notification subscriber failed: {error}")
+        self.healthy = False
+        worker.stop()
+
+    def handle_added(self, message):
+        if not message["channel"].startswith(self.channel_prefix):
+            return
+        key = message["data"]
+        if not b"0" <= key[:1] <= b"9" or key.count(b":") < 2:
+            return
+        with self.lock:
+            self.keys.add(key)
+            self.added.add(key)
+            self.removed.discard(key)
+
+    def handle_removed(self, message):
+        if not message["channel"].startswith(self.channel_prefix):
+            return
+        key = message["data"]
+        with self.lock:
+            self.keys.discard(key)
+            self.removed.add(key)
+            self.added.discard(key)
+
+    def snapshot(self, scan_count):
+        now = time.time()
+        full_scan = (
+            self.last_full_scan is None
+            or now - self.last_full_scan >= self.full_scan_interval
+        )
+        if not self.healthy or not all(worker.is_alive() for worker in self.workers):
+            # Re-subscribe before scanning so events seen during the scan are
+            # applied on top; until that works every poll is a full scan
+            self.restart()
+            full_scan = True
+
+        if full_scan:
+            with self.lock:
+                self.added = set()
+                self.removed = set()
+            scanned = set(scan_keys(self.r, scan_count))
+            with self.lock:
+                self.keys = (scanned - self.removed) | self.added
+            self.last_full_scan = now
+
+        with self.lock:
+            return list(self.keys)
+
+
+def window_batches(r, keys):
+    # A script may only touch keys of one slot in cluster mode
+    if isinstance(r, RedisCluster):
+        groups = {}
+        for key in keys:
+            groups.setdefault(r.keyslot(key), []).append(key)
+        groups = groups.values()
+    else:
+        groups = [keys]
+
+    for group in groups:
+        for i in range(0, len(group), SUM_WINDOW_BATCH_SIZE):
+            yield group[i : i + SUM_WINDOW_BATCH_SIZE]
+
+
+def get_window_pipeline(r):
+    global window_pipeline
+    if window_pipeline is None or window_pipeline[0] is not r:
+        window_pipeline = (r, r.pipeline(transaction=False))
+    pipe = window_pipeline[1]
+    # execute() already resets the pipeline, this clears anything left over
+    # from a poll that failed while queuing commands
+    pipe.reset()
+    return pipe
+
+
+def sum_windows(r, keys):
+    global use_sum_script
+    if use_sum_script:
+        try:
+            return script_sum_windows(r, keys)
+        except NoPermissionError as e:
+            logging.warning(
+                f"Not allowed to run the window sum script, summing hashes "
+                f"client side from now on: {e}"
+            )
+            use_sum_script = False
+
+    pipe = get_window_pipeline(r)
+    for key in keys:
+        pipe.hgetall(key)
+    return [sum(map(int, counters.values())) for counters in pipe.execute()]
+
+
+def script_sum_windows(r, keys):
+    batches = list(window_batches(r, keys))
+    for attempt in range(2):
+        # Evaluate every batch in one round trip; cluster pipelines split
+        # the batches per node and write to all nodes before reading any
+        # reply, so a poll costs roughly the slowest node's RTT.
+        pipe = get_window_pipeline(r)
+        for batch in batches:
+            pipe.evalsha(SUM_WINDOW_SHA, len(batch), *batch)
+        try:
+            results = pipe.execute()
+            break
+        except NoScriptError:
+            if attempt:
+                raise
+            # The script cache is empty after a restart or failover
+            logging.info("Loading window sum script into Redis")
+            r.script_load(SUM_WINDOW_SCRIPT)
+
+    totals = {}
+    for batch, batch_totals in zip(batches, results):
+        totals.update(zip(batch, batch_totals))
+    return [totals[key] for key in keys]
+
+
+def py_parse_oldest_windows(keys):
+    # Find the oldest window for each (window_size, uuid) combination while
+    # streaming the SCAN results. Builtins and methods used per key are bound
+    # to locals to skip the global and attribute lookups in the loop.
+    oldest_windows = {}
+    oldest_windows_get = oldest_windows.get
+    split, isdigit, to_int, length = bytes.split, bytes.isdigit, int, len
+    for key in keys:
+        # Counter keys start with a timestamp, skip anything else before
+        # paying for the split
+        if not b"0" <= key[:1] <= b"9":
+            continue
+        parts = split(key, b":", 2)
+        if length(parts) != 3:
+            continue
+        timestamp, window_size, uuid = parts
+        if not (isdigit(timestamp) and isdigit(window_size)):
+            continue
+        timestamp = to_int(timestamp)
+        window = (window_size, uuid)
+
+        oldest = oldest_windows_get(window)
+        if oldest is None or timestamp < oldest[0]:
+            oldest_windows[window] = (timestamp, key)
+    return oldest_windows
+
+
+try:
+    # Compiled version of the loop above, built from _scanparse.pyx
+    from _scanparse import parse_oldest_windows
+except ImportError:
+    parse_oldest_windows = py_parse_oldest_windows
+
+
+def count_rl_counters(r, keep_zero, scan_count=1024, key_tracker=None):
     global previous_window_counts
     current_window_counts = {}
-    oldest_windows = {}
-    key_regex = re.compile(r"(\d+):(\d+):(.*)")
     current_time = time.time()
 
-    # First pass: find the oldest window for each window_size-uuid combination
-    for key in r.scan_iter(match="*:*:*"):  # Match any key with two colons
-        match = key_regex.match(key)
-        if match:
-            timestamp, window_size, uuid = match.groups()
-            timestamp = int(timestamp)
-            identifier = f"{window_size}-{uuid}"
-
-            if (
-                identifier not in oldest_windows
-                or timestamp < oldest_windows[identifier][0]
-            ):
-                oldest_windows[identifier] = (timestamp, key)
-
-    # Second pass: count the values for the oldest windows
-    total_count = 0
-    for identifier, (_, key) in oldest_windows.items():
-        hash_entries = r.hgetall(key)
-        window_total = sum(int(value) for value in hash_entries.values())
+    if key_tracker is not None:
+        keys = key_tracker.snapshot(scan_count)
+    else:
+        keys = scan_keys(r, scan_count)
 
-        current_window_counts[identifier] = (window_total, current_time)
-        total_count += window_total
+    oldest_windows = parse_oldest_windows(keys)
+
+    # Count the values for the oldest windows
+    window_totals = sum_windows(r, [key for _, key in oldest_windows.values()])
 
-    # Check for expired counters and set them to zero
-    expired_counters = []
-    for identifier, (count, last_seen) in previous_window_counts.items():
-        if identifier not in current_window_counts:
-            if (
-                current_time - last_seen <= keep_zero
-            ):  # Keep zero value for 30 seconds (default)
-                current_window_counts[identifier] = (0, last_seen)
-            else:
-                expired_counters.append(identifier)
+    total_count = 0
+    for (window_size, uuid), window_total in zip(oldest_windows, window_totals):
+        window = (window_size.decode(), uuid.decode())
+        current_window_counts[window] = (window_total, current_time)
+        total_count += window_total
 
-    # Remove expired counters
-    for identifier in expired_counters:
-        del previous_window_counts[identifier]
+    with previous_window_counts_lock:
+        # Check for expired counters and set them to zero; counters past
+        # keep_zero are dropped by not carrying them over
+        for window, (count, last_seen) in previous_window_counts.items():
+            if window not in current_window_counts:
+                if (
+                    current_time - last_seen <= keep_zero
+                ):  # Keep zero value for 30 seconds (default)
+                    current_window_counts[window] = (0, last_seen)
 
-    # Update the previous_window_counts for the next iteration
-    previous_window_counts = current_window_counts.copy()
+        # Update the previous_window_counts for the next iteration. Callers
+        # only read the returned dict, so it can be shared without a copy.
+        previous_window_counts = current_window_counts
 
     return total_count, current_window_counts
 
 
-def collect_metrics(redis_client, instance, keep_zero):
+def collect_metrics(
+    redis_client, instance, keep_zero, scan_count=1024, key_tracker=None
+):
     try:
-        total_count, window_counts = count_rl_counters(redis_client, keep_zero)
+        total_count, window_counts = count_rl_counters(
+            redis_client, keep_zero, scan_count, key_tracker
+        )
 
         # Update total requests metric
         rate_limiting_total_requests.labels(instance=instance).set(total_count)
@@ -128,30 +474,62 @@ def collect_metrics(redis_client, instance, keep_zero):
         )
 
         # Update individual window metrics
-        for identifier, (count, _) in window_counts.items():
-            window_size, uuid = identifier.split("-", 1)
-            rate_limiting_window_requests.labels(
-                instance=instance,
-                window_size=window_size,
-                uuid=uuid,
-                identifier=identifier,
-            ).set(count)
+        for (window_size, uuid), (count, _) in window_counts.items():
+            labels = (instance, window_size, uuid)
+            gauge = window_gauges.get(labels)
+            if gauge is None:
+                gauge = rate_limiting_window_requests.labels(
+                    instance=instance,
+                    window_size=window_size,
+                    uuid=uuid,
+                )
+                window_gauges[labels] = gauge
+            gauge.set(count)
             logging.info(
-                f"Updated rate limiting window requests metric for {instance}: {identifier} = {count}"
+                f"Updated rate limiting window requests metric for {instance}: {window_size}-{uuid} = {count}"
             )
 
+        # Drop the series of windows that expired past keep_zero
+        if len(window_gauges) > len(window_counts):
+            for labels in list(window_gauges):
+                if labels[1:] not in window_counts:
+                    rate_limiting_window_requests.remove(*labels)
+                    del window_gauges[labels]
+
     except Exception as e:
         logging.error(f"Error collecting metrics: {e}")
 
 
-def main(r, port, host, keep_zero, sleep_time=5):
+def collect_loop(r, host, keep_zero, sleep_time, scan_count, key_tracker=None):
+    while not shutdown_event.is_set():
+        collect_metrics(r, host, keep_zero, scan_count, key_tracker)
+        shutdown_event.wait(sleep_time)
+    logging.info("Metrics collection stopped.")
+
+
+def main(r, port, host, keep_zero, sleep_time=5, scan_count=1024, key_tracker=None):
+    global scan_type
+    if supports_scan_type(r):
+        scan_type = "hash"
+    else:
+        logging.info("SCAN TYPE is not supported, filtering keys client side")
+
     # Start up the server to expose the metrics.
     start_http_server(port)
     logging.info(f"Prometheus metrics server started on port {port}")
-    while not shutdown_flag:
-        collect_metrics(r, host, keep_zero)
-        time.sleep(sleep_time)
-    logging.info("Metrics collection stopped.")
+
+    # Collect in the background so scrapes never wait on Redis
+    collector = threading.Thread(
+        target=collect_loop,
+        args=(r, host, keep_zero, sleep_time, scan_count, key_tracker),
+        name="collector",
+        daemon=True,
+    )
+    collector.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: shutdown_event.set())
+    collector.join()
+    if key_tracker is not None:
+        key_tracker.stop()
 
 
 if __name__ == "__main__":
@@ -210,8 +588,31 @@ if __name__ == "__main__":
         default=5,
         help="Time to sleep between metric collections",
     )
+    parser.add_argument(
+        "--scan-count",
+        type=int,
+        default=1024,
+        help="COUNT hint passed to each SCAN call when listing counter keys",
+    )
+    parser.add_argument(
+        "--keyspace-events",
+        action="store_true",
+        help="Track counter keys from keyspace notifications between full scans",
+    )
+    parser.add_argument(
+        "--full-scan-interval",
+        type=int,
+        default=60,
+        help="Seconds between full keyspace scans when --keyspace-events is set",
+    )
     args = parser.parse_args()
 
+    if args.scan_count > 10000:
+        logging.warning(
+            f"--scan-count {args.scan_count} is very large, each SCAN call may "
+            "block the Redis main thread noticeably"
+        )
+
     try:
         redis_client = create_redis_client(
             host=args.host,
@@ -221,6 +622,19 @@ if __name__ == "__main__":
             ssl=args.ssl,
             is_cluster=args.cluster,
         )
-        main(redis_client, args.metric_port, args.host, args.keep_zero, args.sleep_time)
+        key_tracker = None
+        if args.keyspace_events:
+            key_tracker = KeyspaceTracker(redis_client, args.full_scan_interval)
+            key_tracker.check_server_config()
+            key_tracker.start()
+        main(
+            redis_client,
+            args.metric_port,
+            args.host,
+            args.keep_zero,
+            args.sleep_time,
+            args.scan_count,
+            key_tracker,
+        )
     except Exception as e:
         logging.error(f"Exporter failed to start: {e}")
@@ -1,16 +1,44 @@
 import unittest
-from unittest.mock import Mock, patch, ANY
-from redis_sample_prometheus import count_rl_counters, collect_metrics
+from unittest.mock import Mock, patch, ANY, call
+from redis.cluster import RedisCluster
+from redis.exceptions import (
+    ConnectionError,
+    NoPermissionError,
+    NoScriptError,
+    ResponseError,
+)
+from redis_sample_prometheus import (
+    KeyspaceTracker,
+    py_parse_oldest_windows,
+    SUM_WINDOW_SCRIPT,
+    SUM_WINDOW_SHA,
+    count_rl_counters,
+    collect_loop,
+    collect_metrics,
+    shutdown_event,
+    supports_scan_type,
+)
+
+try:
+    import _scanparse
+except ImportError:
+    _scanparse = None
 
 
 class TestPrometheusExporter(unittest.TestCase):
 
     def setUp(self):
         self.mock_redis = Mock()
+        self.mock_redis.pipeline.return_value.execute.return_value = []
+        self.mock_redis.connection_pool.connection_kwargs = {}
         # Clear previous_window_counts before each test
         import redis_sample_prometheus
 
         redis_sample_prometheus.previous_window_counts = {}
+        redis_sample_prometheus.window_gauges = {}
+        redis_sample_prometheus.window_pipeline = None
+        redis_sample_prometheus.use_sum_script = True
+        shutdown_event.clear()
 
     def test_count_rl_counters_empty(self):
         self.mock_redis.scan_iter.return_value = []
@@ -19,37 +47,194 @@ class TestPrometheusExporter(unittest.TestCase):
         self.assertEqual(window_counts, {})
 
     def test_count_rl_counters_single_window(self):
-        self.mock_redis.scan_iter.return_value = ["1000:60:abc123"]
-        self.mock_redis.hgetall.return_value = {"field1": "5", "field2": "10"}
+        self.mock_redis.scan_iter.return_value = [b"1000:60:abc123"]
+        self.mock_redis.pipeline.return_value.execute.return_value = [[15]]
         total_count, window_counts = count_rl_counters(self.mock_redis, 30)
         self.assertEqual(total_count, 15)
-        self.assertEqual(window_counts, {"60-abc123": (15, ANY)})
+        self.assertEqual(window_counts, {("60", "abc123"): (15, ANY)})
+
+    def test_count_rl_counters_scan_count(self):
+        self.mock_redis.scan_iter.return_value = []
+        count_rl_counters(self.mock_redis, 30, scan_count=500)
+        self.mock_redis.scan_iter.assert_called_once_with(
+            match="*:*:*", count=500, _type=None
+        )
+
+    def test_count_rl_counters_skips_foreign_keys(self):
+        self.mock_redis.scan_iter.return_value = [
+            b"session:60:abc123",
+            b"1000:minute:abc123",
+            b"1000:60:abc123",
+        ]
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.return_value = [[5]]
+        total_count, window_counts = count_rl_counters(self.mock_redis, 30)
+        pipe.evalsha.assert_called_once_with(SUM_WINDOW_SHA, 1, b"1000:60:abc123")
+        self.assertEqual(total_count, 5)
+        self.assertEqual(window_counts, {("60", "abc123"): (5, ANY)})
+
+    @unittest.skipIf(_scanparse is None, "_scanparse extension is not built")
+    def test_parse_oldest_windows_extension_matches_python(self):
+        keys = [
+            b"1100:60:abc123",
+            b"1000:60:abc123",
+            b"1000:5:ns:with:colons",
+            b"99999999999999999999:5:big",
+            b"session:60:abc123",
+            b"1000:minute:abc123",
+            b"-5:60:abc123",
+            b"1000::abc123",
+            b":60:abc123",
+            b"1000:60",
+        ]
+        self.assertEqual(
+            _scanparse.parse_oldest_windows(keys), py_parse_oldest_windows(keys)
+        )
+
+    @patch("redis_sample_prometheus.scan_type", "hash")
+    def test_count_rl_counters_scan_type(self):
+        self.mock_redis.scan_iter.return_value = []
+        count_rl_counters(self.mock_redis, 30)
+        self.mock_redis.scan_iter.assert_called_once_with(
+            match="*:*:*", count=1024, _type="hash"
+        )
+
+    def test_supports_scan_type(self):
+        self.mock_redis.info.return_value = {"redis_version": "7.0.12"}
+        self.assertTrue(supports_scan_type(self.mock_redis))
+        self.mock_redis.info.assert_called_once_with("server")
+        self.mock_redis.info.return_value = {"redis_version": "5.0.6"}
+        self.assertFalse(supports_scan_type(self.mock_redis))
 
     def test_count_rl_counters_multiple_windows(self):
         self.mock_redis.scan_iter.return_value = [
-            "1000:60:abc123",
-            "1100:60:abc123",  # Newer timestamp, should be ignored
-            "1000:120:def456",
+            b"1000:60:abc123",
+            b"1100:60:abc123",  # Newer timestamp, should be ignored
+            b"1000:120:def456",
         ]
-        self.mock_redis.hgetall.side_effect = [
-            {"field1": "5", "field2": "10"},  # For 60:abc123
-            {"field1": "15", "field2": "20"},  # For 120:def456
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.return_value = [
+            [
+                15,  # For 60:abc123
+                35,  # For 120:def456
+            ]
         ]
         total_count, window_counts = count_rl_counters(self.mock_redis, 30)
+        self.mock_redis.pipeline.assert_called_once_with(transaction=False)
+        pipe.evalsha.assert_called_once_with(
+            SUM_WINDOW_SHA, 2, b"1000:60:abc123", b"1000:120:def456"
+        )
+        pipe.execute.assert_called_once_with()
+        self.assertEqual(total_count, 50)
+        self.assertEqual(
+            window_counts, {("60", "abc123"): (15, ANY), ("120", "def456"): (35, ANY)}
+        )
+
+    def mock_cluster(self, *node_keys):
+        cluster = Mock(spec=RedisCluster)
+        cluster.pipeline.return_value.execute.return_value = []
+        nodes = [Mock(scan_iter=Mock(return_value=keys)) for keys in node_keys]
+        cluster.get_primaries.return_value = nodes
+        cluster.get_redis_connection.side_effect = lambda node: node
+        return cluster
+
+    def test_count_rl_counters_cluster_scans_each_primary(self):
+        cluster = self.mock_cluster([b"1000:60:abc123"], [b"1000:120:def456"])
+        cluster.keyslot.return_value = 1
+        cluster.pipeline.return_value.execute.return_value = [[15, 35]]
+        total_count, window_counts = count_rl_counters(cluster, 30, scan_count=500)
+        for node in cluster.get_primaries.return_value:
+            node.scan_iter.assert_called_once_with(match="*:*:*", count=500, _type=None)
+        cluster.scan_iter.assert_not_called()
+        self.assertEqual(total_count, 50)
+
+    def test_count_rl_counters_cluster_scan_falls_back(self):
+        cluster = self.mock_cluster([b"1000:60:abc123"])
+        cluster.get_redis_connection.side_effect = ConnectionError("node down")
+        cluster.scan_iter.return_value = [b"1000:60:abc123"]
+        cluster.keyslot.return_value = 1
+        cluster.pipeline.return_value.execute.return_value = [[15]]
+        total_count, _ = count_rl_counters(cluster, 30)
+        cluster.scan_iter.assert_called_once_with(match="*:*:*", count=1024, _type=None)
+        self.assertEqual(total_count, 15)
+
+    def test_count_rl_counters_cluster_batches_by_slot(self):
+        cluster = self.mock_cluster(
+            [b"1000:60:abc123", b"1000:120:def456"], [b"1000:5:ghi789"]
+        )
+        cluster.keyslot.side_effect = lambda key: 1 if b"def456" in key else 2
+        pipe = cluster.pipeline.return_value
+        pipe.execute.return_value = [[15, 7], [35]]
+        total_count, window_counts = count_rl_counters(cluster, 30)
+        self.assertEqual(
+            pipe.evalsha.call_args_list,
+            [
+                call(SUM_WINDOW_SHA, 2, b"1000:60:abc123", b"1000:5:ghi789"),
+                call(SUM_WINDOW_SHA, 1, b"1000:120:def456"),
+            ],
+        )
+        self.assertEqual(total_count, 57)
+        self.assertEqual(
+            window_counts,
+            {
+                ("60", "abc123"): (15, ANY),
+                ("120", "def456"): (35, ANY),
+                ("5", "ghi789"): (7, ANY),
+            },
+        )
+
+    def test_count_rl_counters_reuses_pipeline(self):
+        self.mock_redis.scan_iter.return_value = [b"1000:60:abc123"]
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.return_value = [[15]]
+        count_rl_counters(self.mock_redis, 30)
+        count_rl_counters(self.mock_redis, 30)
+        self.mock_redis.pipeline.assert_called_once_with(transaction=False)
+        self.assertEqual(pipe.reset.call_count, 2)
+        self.assertEqual(pipe.execute.call_count, 2)
+
+    def test_count_rl_counters_falls_back_without_script_permission(self):
+        self.mock_redis.scan_iter.return_value = [
+            b"1000:60:abc123",
+            b"1000:120:def456",
+        ]
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.side_effect = [
+            NoPermissionError("NOPERM"),
+            [{b"field1": b"5", b"field2": b"10"}, {b"field1": b"35"}],
+            [{b"field1": b"7"}, {b"field1": b"1"}],
+        ]
+        total_count, window_counts = count_rl_counters(self.mock_redis, 30)
+        self.assertEqual(
+            pipe.hgetall.call_args_list,
+            [call(b"1000:60:abc123"), call(b"1000:120:def456")],
+        )
         self.assertEqual(total_count, 50)
         self.assertEqual(
-            window_counts, {"60-abc123": (15, ANY), "120-def456": (35, ANY)}
+            window_counts, {("60", "abc123"): (15, ANY), ("120", "def456"): (35, ANY)}
         )
 
+        # The script is not retried on later polls
+        total_count, _ = count_rl_counters(self.mock_redis, 30)
+        pipe.evalsha.assert_called_once()
+        self.mock_redis.script_load.assert_not_called()
+        self.assertEqual(total_count, 8)
+
+    def test_count_rl_counters_loads_missing_script(self):
+        self.mock_redis.scan_iter.return_value = [b"1000:60:abc123"]
+        pipe = self.mock_redis.pipeline.return_value
+        pipe.execute.side_effect = [NoScriptError("NOSCRIPT"), [[15]]]
+        total_count, window_counts = count_rl_counters(self.mock_redis, 30)
+        self.mock_redis.script_load.assert_called_once_with(SUM_WINDOW_SCRIPT)
+        self.assertEqual(pipe.execute.call_count, 2)
+        self.assertEqual(total_count, 15)
+
     @patch("redis_sample_prometheus.rate_limiting_total_requests")
     @patch("redis_sample_prometheus.rate_limiting_window_requests")
     def test_collect_metrics(self, mock_window_requests, mock_total_requests):
         mock_redis = Mock()
-        mock_redis.scan_iter.return_value = ["1000:60:abc123", "1000:120:def456"]
-        mock_redis.hgetall.side_effect = [
-            {"field1": "5", "field2": "10"},
-            {"field1": "15", "field2": "20"},
-        ]
+        mock_redis.scan_iter.return_value = [b"1000:60:abc123", b"1000:120:def456"]
+        mock_redis.pipeline.return_value.execute.return_value = [[15, 35]]
         collect_metrics(mock_redis, "redis-instance1", 30)
         mock_total_requests.labels.assert_called_once_with(instance="redis-instance1")
         mock_total_requests.labels().set.assert_called_once_with(50)
@@ -58,17 +243,168 @@ class TestPrometheusExporter(unittest.TestCase):
             instance="redis-instance1",
             window_size="60",
             uuid="abc123",
-            identifier="60-abc123",
         )
         mock_window_requests.labels.assert_any_call(
             instance="redis-instance1",
             window_size="120",
             uuid="def456",
-            identifier="120-def456",
         )
         mock_window_requests.labels().set.assert_any_call(15)
         mock_window_requests.labels().set.assert_any_call(35)
 
+    @patch("redis_sample_prometheus.rate_limiting_total_requests")
+    @patch("redis_sample_prometheus.rate_limiting_window_requests")
+    def test_collect_metrics_reuses_and_prunes_gauges(
+        self, mock_window_requests, mock_total_requests
+    ):
+        mock_redis = Mock()
+        mock_redis.scan_iter.return_value = [b"1000:60:abc123"]
+        mock_redis.pipeline.return_value.execute.return_value = [[15]]
+        collect_metrics(mock_redis, "redis-instance1", -1)
+        collect_metrics(mock_redis, "redis-instance1", -1)
+        mock_window_requests.labels.assert_called_once()
+        self.assertEqual(mock_window_requests.labels().set.call_count, 2)
+        mock_window_requests.remove.assert_not_called()
+
+        # The window expired and keep_zero is already exceeded
+        mock_redis.scan_iter.return_value = []
+        mock_redis.pipeline.return_value.execute.return_value = []
+        collect_metrics(mock_redis, "redis-instance1", -1)
+        mock_window_requests.remove.assert_called_once_with(
+            "redis-instance1", "60", "abc123"
+        )
+
+    @patch("redis_sample_prometheus.collect_metrics")
+    def test_collect_loop_stops_on_shutdown(self, mock_collect_metrics):
+        mock_collect_metrics.side_effect = lambda *args: shutdown_event.set()
+        collect_loop(self.mock_redis, "redis-instance1", 30, 5, 1024)
+        mock_collect_metrics.assert_called_once_with(
+            self.mock_redis, "redis-instance1", 30, 1024, None
+        )
+
+    def test_keyspace_tracker_applies_events_between_scans(self):
+        self.mock_redis.scan_iter.return_value = [b"1000:60:abc123"]
+        tracker = KeyspaceTracker(self.mock_redis, 60)
+        self.assertEqual(tracker.snapshot(1024), [b"1000:60:abc123"])
+
+        tracker.handle_added(
+            {"channel": b"__keyevent@0__:hincrby", "data": b"1005:60:abc123"}
+        )
+        tracker.handle_added({"channel": b"__keyevent@0__:hincrby", "data": b"session"})
+        tracker.handle_removed(
+            {"channel": b"__keyevent@0__:del", "data": b"1000:60:abc123"}
+        )
+        self.assertEqual(tracker.snapshot(1024), [b"1005:60:abc123"])
+        self.mock_redis.scan_iter.assert_called_once()
+
+    def test_keyspace_tracker_ignores_other_databases(self):
+        self.mock_redis.scan_iter.return_value = [b"1000:60:abc123"]
+        tracker = KeyspaceTracker(self.mock_redis, 60)
+        tracker.snapshot(1024)
+        tracker.handle_added(
+            {"channel": b"__keyevent@1__:hset", "data": b"900:60:abc123"}
+        )
+        tracker.handle_removed(
+            {"channel": b"__keyevent@1__:del", "data": b"1000:60:abc123"}
+        )
+        self.assertEqual(tracker.snapshot(1024), [b"1000:60:abc123"])
+
+    def test_keyspace_tracker_subscribes_to_client_database(self):
+        self.mock_redis.connection_pool.connection_kwargs = {"db": 2}
+        tracker = KeyspaceTracker(self.mock_redis, 60)
+        tracker.start()
+        patterns = self.mock_redis.pubsub.return_value.psubscribe.call_args[1]
+        self.assertIn("__keyevent@2__:hincrby", patterns)
+        self.assertTrue(all(p.startswith("__keyevent@2__:") for p in patterns))
+
+    def test_keyspace_tracker_rescans_after_interval(self):
+        self.mock_redis.scan_iter.return_value = [b"1000:60:abc123"]
+        tracker = KeyspaceTracker(self.mock_redis, 60)
+        tracker.snapshot(1024)
+        tracker.handle_added(
+            {"channel": b"__keyevent@0__:hincrby", "data": b"1005:60:abc123"}
+        )
+
+        tracker.last_full_scan -= 61
+        self.mock_redis.scan_iter.return_value = [b"1010:60:abc123"]
+        self.assertEqual(tracker.snapshot(1024), [b"1010:60:abc123"])
+        self.assertEqual(self.mock_redis.scan_iter.call_count, 2)
+
+    def test_keyspace_tracker_rescans_after_dead_worker(self):
+        self.mock_redis.scan_iter.return_value = [
+            b"1000:60:abc123",
+            b"1060:60:abc123",
+        ]
+        tracker = KeyspaceTracker(self.mock_redis, 60)
+        tracker.snapshot(1024)
+
+        # The subscriber died and missed the first key being deleted
+        dead_worker = Mock()
+        dead_worker.is_alive.return_value = False
+        tracker.workers = [dead_worker]
+        self.mock_redis.scan_iter.return_value = [b"1060:60:abc123"]
+        with patch.object(tracker, "start") as start:
+            self.assertEqual(
+                py_parse_oldest_windows(tracker.snapshot(1024)),
+                {(b"60", b"abc123"): (1060, b"1060:60:abc123")},
+            )
+        dead_worker.stop.assert_called_once_with()
+        start.assert_called_once_with()
+        self.assertEqual(self.mock_redis.scan_iter.call_count, 2)
+
+    def test_keyspace_tracker_full_scans_until_resubscribed(self):
+        self.mock_redis.scan_iter.return_value = [b"1000:60:abc123"]
+        self.mock_redis.pubsub.return_value.psubscribe.side_effect = ConnectionError(
+            "connection refused"
+        )
+        tracker = KeyspaceTracker(self.mock_redis, 60)
+        worker = Mock()
+        tracker.workers = [worker]
+        tracker.handle_worker_error(ConnectionError("gone"), Mock(), worker)
+        worker.stop.assert_called_once_with()
+        self.assertFalse(tracker.healthy)
+
+        tracker.snapshot(1024)
+        tracker.snapshot(1024)
+        self.assertFalse(tracker.healthy)
+        self.assertEqual(self.mock_redis.scan_iter.call_count, 2)
+        self.mock_redis.pubsub.return_value.close.assert_called_with()
+
+        self.mock_redis.pubsub.return_value.psubscribe.side_effect = None
+        tracker.snapshot(1024)
+        self.assertTrue(tracker.healthy)
+        self.assertEqual(self.mock_redis.scan_iter.call_count, 3)
+        self.mock_redis.pubsub.return_value.run_in_thread.assert_called_once_with(
+            sleep_time=1, daemon=True, exception_handler=tracker.handle_worker_error
+        )
+
+    @patch("redis_sample_prometheus.logging.warning")
+    def test_keyspace_tracker_checks_server_config(self, mock_warning):
+        tracker = KeyspaceTracker(self.mock_redis, 60)
+        self.mock_redis.config_get.return_value = {b"notify-keyspace-events": b"KEA"}
+        tracker.check_server_config()
+        self.mock_redis.config_get.assert_called_once_with("notify-keyspace-events")
+        mock_warning.assert_not_called()
+
+        self.mock_redis.config_get.return_value = {b"notify-keyspace-events": b"Eh"}
+        tracker.check_server_config()
+        self.assertIn("lacks 'gxe'", mock_warning.call_args[0][0])
+
+        self.mock_redis.config_get.side_effect = ResponseError("unknown command")
+        tracker.check_server_config()
+        self.assertIn(
+            "Could not verify notify-keyspace-events", mock_warning.call_args[0][0]
+        )
+
+    def test_count_rl_counters_uses_key_tracker(self):
+        key_tracker = Mock()
+        key_tracker.snapshot.return_value = [b"1000:60:abc123"]
+        self.mock_redis.pipeline.return_value.execute.return_value = [[15]]
+        total_count, _ = count_rl_counters(self.mock_redis, 30, key_tracker=key_tracker)
+        key_tracker.snapshot.assert_called_once_with(1024)
+        self.mock_redis.scan_iter.assert_not_called()
+        self.assertEqual(total_count, 15)
+
 
 if __name__ == "__main__":
     unittest.main()